@@ -1,6 +1,8 @@
 """
 import public modules and classes from faststore
 """
+from importlib.util import find_spec
+
 from .main import FastStore, FileData, Store, FileField
 from .memorystorage import MemoryStorage
 from .localstorage import LocalStorage
@@ -9,7 +11,16 @@ from .exceptions import FileStoreError
 from .structs import FileField, FileData, Config, UploadFile
 from .storage_engines import StorageEngine, LocalEngine, MemoryEngine
 
-try:
-    from .s3 import S3Engine, S3Storage
-except ImportError as err:
-    pass
\ No newline at end of file
+__all__ = ['FastStore', 'FileData', 'Store', 'FileField', 'MemoryStorage', 'LocalStorage', 'FileStore',
+           'FileStoreError', 'Config', 'UploadFile', 'StorageEngine', 'LocalEngine', 'MemoryEngine']
+
+if find_spec('boto3') is not None:
+    __all__ += ['S3Engine', 'S3Storage']
+
+
+def __getattr__(name: str):
+    """Import the S3 classes on first access, so that boto3 is only loaded by applications that use them."""
+    if name in ('S3Engine', 'S3Storage'):
+        from . import s3
+        return getattr(s3, name)
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
\ No newline at end of file
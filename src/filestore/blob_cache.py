@@ -0,0 +1,86 @@
+"""
+An in-process cache of stored blobs keyed by the sha256 digest of their content. Storage engines use it to skip
+writing content that has already been stored, and to make concurrent uploads of the same content share a single write.
+"""
+import asyncio
+import hashlib
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, BinaryIO, Callable, Dict, Optional, Tuple
+
+
+def file_digest(file: BinaryIO, chunk_size: int) -> str:
+    """Compute the sha256 digest of a file object from its current position. The position is restored afterwards.
+
+    Args:
+        file (BinaryIO): The file object.
+        chunk_size (int): The size of each chunk read from the file.
+
+    Returns:
+        str: The hex digest of the content of the file.
+    """
+    pos, hasher = file.tell(), hashlib.sha256()
+    while chunk := file.read(chunk_size):
+        hasher.update(chunk)
+    file.seek(pos)
+    return hasher.hexdigest()
+
+
+class BlobCache:
+    """
+    A bounded LRU cache mapping content digests to the location the content was stored at.
+
+    Attributes:
+        maxsize (int): The maximum number of digests to keep.
+        ttl (float): The number of seconds a digest is kept for.
+    """
+
+    def __init__(self, maxsize: int = 4096, ttl: float = 3600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._blobs: 'OrderedDict[str, Tuple[float, Any]]' = OrderedDict()
+        self._locks: Dict[str, asyncio.Lock] = {}
+
+    def get(self, digest: str) -> Optional[Any]:
+        """Get the location of a stored blob, or None if the digest is unknown or has expired."""
+        entry = self._blobs.get(digest)
+        if entry is None:
+            return None
+        if time.monotonic() - entry[0] > self.ttl:
+            del self._blobs[digest]
+            return None
+        self._blobs.move_to_end(digest)
+        return entry[1]
+
+    def put(self, digest: str, value: Any):
+        """Record the location of a stored blob."""
+        self._blobs[digest] = (time.monotonic(), value)
+        self._blobs.move_to_end(digest)
+        while len(self._blobs) > self.maxsize:
+            self._blobs.popitem(last=False)
+
+    async def get_or_put(self, digest: str, store: Callable[[Optional[Any]], Awaitable[Any]]) -> Any:
+        """
+        Store a blob. The store coroutine function is called with the location the content was previously stored at,
+        or None, and returns the location it stored the content at. Calls for the same digest run one at a time, so
+        concurrent uploads of the same content reuse the first write.
+
+        Args:
+            digest (str): The digest of the content.
+            store (Callable[[Any | None], Awaitable[Any]]): The coroutine function that stores the content.
+
+        Returns:
+            Any: The location of the stored content.
+        """
+        lock = self._locks.setdefault(digest, asyncio.Lock())
+        try:
+            async with lock:
+                value = await store(self.get(digest))
+                self.put(digest, value)
+                return value
+        finally:
+            if self._locks.get(digest) is lock and not lock.locked():
+                del self._locks[digest]
+
+
+blob_cache = BlobCache()
@@ -0,0 +1,124 @@
+"""
+Form parsing for FastStore. Multipart forms are parsed in a worker thread so that large uploads do not block the
+event loop while python-multipart processes the request body.
+"""
+from logging import getLogger
+from typing import Optional, Union
+
+from fastapi import Request, HTTPException
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import FormData
+from starlette.formparsers import MultiPartParser, MultiPartException, parse_options_header, multipart
+
+logger = getLogger(__name__)
+
+
+class ThreadedMultiPartParser(MultiPartParser):
+    """
+    A MultiPartParser that feeds the request body to python-multipart in a worker thread. Writing the file parts to
+    their spooled temporary files is done in the same thread, so each chunk of the request body costs a single
+    threadpool dispatch. It follows the private internals of Starlette 0.27's MultiPartParser.parse, get_form checks
+    that they are present before using it; test_threaded_form checks both parsers give the same form.
+    """
+    _internals = ('_charset', '_file_parts_to_write', '_file_parts_to_finish', '_files_to_close_on_error')
+
+    @property
+    def supported(self) -> bool:
+        """True if the installed Starlette's MultiPartParser has the private internals this parser relies on."""
+        return all(hasattr(self, name) for name in self._internals)
+
+    def _feed(self, parser, chunk: bytes):
+        """Parse a chunk of the request body and write the file parts to their files.
+
+        Args:
+            parser (multipart.MultipartParser): The python-multipart parser.
+            chunk (bytes): A chunk of the request body.
+        """
+        parser.write(chunk)
+        for part, data in self._file_parts_to_write:
+            if part.file.size is not None:
+                part.file.size += len(data)
+            part.file.file.write(data)
+        for part in self._file_parts_to_finish:
+            part.file.file.seek(0)
+        self._file_parts_to_write.clear()
+        self._file_parts_to_finish.clear()
+
+    async def parse(self) -> FormData:
+        _, params = parse_options_header(self.headers['Content-Type'])
+        charset = params.get(b'charset', 'utf-8')
+        if isinstance(charset, bytes):
+            charset = charset.decode('latin-1')
+        self._charset = charset
+        try:
+            boundary = params[b'boundary']
+        except KeyError:
+            raise MultiPartException('Missing boundary in multipart.')
+
+        callbacks = {
+            'on_part_begin': self.on_part_begin,
+            'on_part_data': self.on_part_data,
+            'on_part_end': self.on_part_end,
+            'on_header_field': self.on_header_field,
+            'on_header_value': self.on_header_value,
+            'on_header_end': self.on_header_end,
+            'on_headers_finished': self.on_headers_finished,
+            'on_end': self.on_end,
+        }
+        parser = multipart.MultipartParser(boundary, callbacks)
+        try:
+            async for chunk in self.stream:
+                await run_in_threadpool(self._feed, parser, chunk)
+        except MultiPartException as exc:
+            for file in self._files_to_close_on_error:
+                file.close()
+            raise exc
+
+        parser.finalize()
+        return FormData(self.items)
+
+
+async def get_form(req: Request, *, max_files: Union[int, float] = 1000, max_fields: Union[int, float] = 1000,
+                   threaded: bool = True, spool_max_size: Optional[int] = None) -> FormData:
+    """
+    Get the form data of a request. Multipart forms are parsed with the ThreadedMultiPartParser if threaded is True
+    and the installed Starlette supports it, every other form is parsed by the request object. The parsed form is
+    cached on the request just like Request.form does, so a form that has already been parsed is not parsed again.
+    FastAPI parses the form before the dependencies run when the endpoint has Form or File parameters, for example
+    when it depends on the model of a FastStore instance, and that form is returned as is.
+
+    Args:
+        req (Request): The request object.
+        max_files (int): The maximum number of files to accept.
+        max_fields (int): The maximum number of fields to accept.
+        threaded (bool): Parse multipart forms in a worker thread.
+        spool_max_size (int): The size in bytes up to which an uploaded file is kept in memory before it is rolled
+            over to a temporary file on disk. Defaults to None, Starlette's default of 1MiB. Ignored for a form that
+            has already been parsed.
+
+    Returns:
+        FormData: The form data object.
+    """
+    content_type, _ = parse_options_header(req.headers.get('Content-Type'))
+    if not (threaded or spool_max_size) or getattr(req, '_form', None) is not None \
+            or content_type != b'multipart/form-data':
+        return await req.form(max_files=max_files, max_fields=max_fields)
+
+    try:
+        parser = None
+        if threaded:
+            parser = ThreadedMultiPartParser(req.headers, req.stream(), max_files=max_files, max_fields=max_fields)
+            if not parser.supported:
+                logger.warning('The installed Starlette does not support threaded form parsing')
+                parser = None
+        if parser is None:
+            if not spool_max_size:
+                return await req.form(max_files=max_files, max_fields=max_fields)
+            parser = MultiPartParser(req.headers, req.stream(), max_files=max_files, max_fields=max_fields)
+        if spool_max_size:
+            parser.max_file_size = spool_max_size
+        req._form = await parser.parse()
+    except MultiPartException as exc:
+        logger.error(f'Error parsing form: {exc.message}')
+        raise HTTPException(status_code=400, detail=exc.message)
+    return req._form
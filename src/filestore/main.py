@@ -1,19 +1,23 @@
 """This module contains the main classes and methods for the filestore package."""
 
-import asyncio
-from typing import Type, TypeVar, List, Dict, Union
+from typing import Type, TypeVar, List, Dict, Union, Tuple
 from abc import abstractmethod
+from collections import defaultdict
+from functools import lru_cache
 from logging import getLogger
-from random import randint
+from types import MappingProxyType
+from zlib import crc32
 
 from starlette.datastructures import UploadFile as StarletteUploadFile, FormData
 from fastapi import Request, BackgroundTasks
+from starlette.concurrency import run_in_threadpool
 from pydantic import create_model, Field, BaseModel as FormModel
 
-# from .util import FormModel
-from .structs import FileField, FileData, Store, Config, cache, UploadFile
+from .structs import FileField, FileData, Store, Config, UploadFile, EMPTY_CONFIG
 from .storage_engines import StorageEngine
 from .exceptions import FileStoreError
+from .formparsers import get_form
+from .util import gather_limited
 
 logger = getLogger(__name__)
 Self = TypeVar('Self', bound='FastStore')
@@ -53,6 +57,114 @@ def filename(req: Request, form: FormData, field: str, file: UploadFile) -> Uplo
     return file
 
 
+# the default config of FastStore and FileStore instances, merged with the config passed to them
+DEFAULT_CONFIG: Config = MappingProxyType({'filter': file_filter, 'max_files': 1000, 'max_fields': 1000,
+                                           'filename': filename, 'background': False, 'threaded_parse': True,
+                                           'max_concurrent_uploads': 16})
+
+
+@lru_cache(maxsize=128)
+def _build_model(spec: Tuple[Tuple[str, int, bool], ...]) -> Type[FormModel]:
+    """
+    Build a pydantic model for a form. Models are cached by the spec of the form fields, so instances with the same
+    fields share a single model. The model name is derived from the spec, so it is the same on every run.
+
+    Args:
+        spec (tuple[tuple[str, int, bool], ...]): The name, max_count and required values of each form field.
+
+    Returns:
+        FormModel
+    """
+    body = {}
+    for name, max_count, required in spec:
+        if max_count > 1:
+            body[name] = (List[UploadFile], ...) if required else (List[UploadFile], Field([], validate_default=False))
+        else:
+            body[name] = (UploadFile, ...) if required else (UploadFile, Field(None, validate_default=False))
+    model_name = f"FormModel{crc32(repr(spec).encode()):08x}"
+    return create_model(model_name, **body, __base__=FormModel)
+
+
+def form_model(fields: List[FileField]) -> Type[FormModel]:
+    """
+    Get the pydantic model for the form fields.
+
+    Args:
+        fields (list[FileField]): The fields to expect from the form.
+
+    Returns:
+        FormModel
+    """
+    spec = tuple((field['name'], field.get('max_count', 1), field.get('required', False)) for field in fields)
+    return _build_model(spec)
+
+
+def _merge_config(fields: List[FileField], config: Config) -> List[FileField]:
+    """
+    Merge the config of each field with the config of the instance once, instead of on every request. The merged
+    config is set on a copy of the field, so field dicts shared between instances don't carry one instance's config
+    over to another.
+
+    Args:
+        fields (list[FileField]): The fields of the instance.
+        config (Config): The config of the instance, already merged with DEFAULT_CONFIG.
+
+    Returns:
+        list[FileField]: Copies of the fields, each with its merged config.
+    """
+    return [{**field, 'config': {**config, **field.get('config', EMPTY_CONFIG)}} for field in fields]
+
+
+async def _collect_files(req: Request, form: FormData, fields: List[FileField]) -> List[FileField]:
+    """
+    Collect the files of the form to upload. For each field, files larger than max_filesize and files beyond
+    max_count are rejected before the filter runs, then the filter and the filename function of the field are applied.
+    The temporary files of uploads rejected for their size or count are closed instead of waiting for the request to
+    end. Files rejected by the filter are left open, since the endpoint may still use them, for example through the
+    form model.
+
+    Args:
+        req (Request): The request object.
+        form (FormData): The form data object.
+        fields (list[FileField]): The fields of the instance, with their merged config.
+
+    Returns:
+        list[FileField]: A FileField for each file to upload.
+    """
+    file_fields: List[Union[FileField, Dict]] = []
+    add_file = file_fields.append
+    rejected: List[StarletteUploadFile] = []
+    # group the form values by name in a single pass, instead of scanning the whole form for each field
+    form_values: Dict[str, list] = {}
+    for key, value in form.multi_items():
+        form_values.setdefault(key, []).append(value)
+    for field in fields:
+        name = field['name']
+        count = field.get('max_count', None)
+        config = field['config']
+        _filter, _filename = config.get('filter', file_filter), config.get('filename', filename)
+        threaded_filter, threaded_filename = config.get('threaded_filter'), config.get('threaded_filename')
+        max_filesize = config.get('max_filesize')
+        accepted = 0
+        for file in form_values.get(name, ()):
+            if not _file_filter(file): continue
+            if (count is not None and accepted >= count) or (max_filesize and (file.size or 0) > max_filesize):
+                rejected.append(file)
+                continue
+            keep = await run_in_threadpool(_filter, req, form, name, file) if threaded_filter \
+                else _filter(req, form, name, file)
+            if not keep:
+                continue
+            file = await run_in_threadpool(_filename, req, form, name, file) if threaded_filename \
+                else _filename(req, form, name, file)
+            add_file({**field, 'file': file})
+            accepted += 1
+
+    for file in rejected:
+        await file.close()
+    return file_fields
+
+
 class FastStore:
     """
     The base class for the FastStore package. It is an abstract class and must be inherited from for custom file
@@ -85,12 +197,40 @@ class FastStore:
 
         destination (Callable[[Request, FormData, str, UploadFile], str | Path]): A string a path or a function that
             takes in the request, form and file and returns a path to save the file to in the storage service.
+            Regular functions are run in a worker thread, coroutine functions are awaited.
 
         filter (Callable[[Request, FormData, str, UploadFile], bool]): A function that takes in the request,
             form and file and returns a boolean.
 
+        max_filesize (int): The maximum size in bytes of a file. Larger files are rejected from their size alone,
+            before the filter function runs. Defaults to None, no limit.
+
+        threaded_filter (bool): Run the filter function in a worker thread instead of on the event loop. Use this for
+            filters that block, such as ones that inspect the content of the file. Defaults to False.
+
+        threaded_filename (bool): Run the filename function in a worker thread instead of on the event loop.
+            Defaults to False.
+
         background (bool): A boolean to indicate if the file storage operation should be run in the background.
 
+        threaded_parse (bool): Parse multipart forms in a worker thread instead of on the event loop. Defaults to True.
+            It has no effect if FastAPI has already parsed the form, as it does when the endpoint depends on the model.
+
+        spool_max_size (int): The size in bytes up to which an uploaded file is kept in memory while the form is
+            parsed, larger files are rolled over to a temporary file on disk. Defaults to None, Starlette's 1MiB.
+            Like threaded_parse, it has no effect if FastAPI has already parsed the form.
+
+        max_concurrent_uploads (int): The maximum number of files of a request to upload at a time. Defaults to 16,
+            None means no limit.
+
+        chunk_size (int): The size in bytes of the chunks read from an uploaded file when saving it to disk.
+            Defaults to 64KiB.
+
+        dedupe (bool): Hard link uploads whose content was already saved by this process instead of writing them
+            again. Files with the same content then share a single inode, so they must not be modified in place.
+            For S3 the sha256 of the content is stored in the object metadata and uploads are skipped when the object
+            already exists with the same content. Defaults to False.
+
         extra_args (dict): Extra arguments to pass to the storage service.
 
         bucket (str): The name of the bucket to upload the file to in the cloud storage service.
@@ -127,11 +267,11 @@ class FastStore:
         field = {'name': name, 'max_count': count, 'required': required} if name else {}
         self.fields = fields or []
         self.fields.append(field) if field else ...
-        self.config = {'filter': file_filter, 'max_files': 1000, 'max_fields': 1000, 'filename': filename,
-                       'background': False, **(config or {})}
+        self.config = {**DEFAULT_CONFIG, **(config or EMPTY_CONFIG)}
+        self.fields = _merge_config(self.fields, self.config)
+        self._model = form_model(self.fields)
 
     @property
-    @cache
     def model(self) -> Type[FormModel]:
         """
         Returns a pydantic model for the form fields.
@@ -139,17 +279,7 @@ class FastStore:
         Returns:
             FormModel
         """
-        body = {}
-        for field in self.fields:
-            if field.get('max_count', 1) > 1:
-                body[field['name']] = (List[UploadFile], ...) if field.get('required', False) \
-                    else (List[UploadFile], Field([], validate_default=False))
-            else:
-                body[field['name']] = (UploadFile, ...) if field.get('required', False) \
-                    else (UploadFile, Field(None, validate_default=False))
-        model_name = f"FormModel{randint(100, 1000)}"
-        model = create_model(model_name, **body, __base__=FormModel)
-        return model
+        return self._model
 
     async def __call__(self, req: Request, bgt: BackgroundTasks) -> Self:
         """
@@ -162,30 +292,25 @@ class FastStore:
         Returns:
             FastStore: An instance of the FastStore class.
         """
-        self._store = Store()
+        self._store = Store.model_construct(files=defaultdict(list), failed=defaultdict(list))
         self.request = req
         self.background_tasks = bgt
+        if not self.fields:
+            # there is nothing to store, so don't read and parse the request body
+            self.file_count = 0
+            self._store.message = 'No files were uploaded'
+            return self
         try:
             max_files, max_fields = self.config['max_files'], self.config['max_fields']
-            form = await req.form(max_files=max_files, max_fields=max_fields)
+            form = await get_form(req, max_files=max_files, max_fields=max_fields,
+                                  threaded=self.config['threaded_parse'],
+                                  spool_max_size=self.config.get('spool_max_size'))
             self.form = form
             self.engine = self.StorageEngine(request=req, form=form, background_tasks=bgt)
-            file_fields: List[Union[FileField, Dict]] = []
-            for field in self.fields:
-                name = field['name']
-                count = field.get('max_count', None)
-                files = form.getlist(name)[: count]
-                field['config'] = {**self.config, **field.get('config', {})}
-                for file in files:
-                    config = field['config']
-                    _filter = config.get('filter', file_filter)
-                    if not (_file_filter(file) and _filter(req, form, name, file)): continue
-                    file_dict = {**field, 'file': config.get('filename', filename)(req, form, name, file)}
-                    file_fields.append(file_dict)
-
+            file_fields = await _collect_files(req, form, self.fields)
             self.file_count = len(file_fields)
             if not file_fields:
-                self._store = Store(message='No files were uploaded')
+                self._store.message = 'No files were uploaded'
                 return self
 
             elif len(file_fields) == 1:
@@ -195,7 +320,8 @@ class FastStore:
                 await self.multi_upload(file_fields=file_fields)
         except FileStoreError as err:
             logger.error(f'Error uploading files: {err} in {self.__class__.__name__}')
-            self._store = Store(error=str(err), status=False)
+            self._store = Store.model_construct(error=str(err), status=False, files=defaultdict(list),
+                                               failed=defaultdict(list))
         return self
 
     @abstractmethod
@@ -212,7 +338,11 @@ class FastStore:
         Args:
             file_fields (list[FileField]): A list of FileFields to upload.
         """
-        await asyncio.gather(*[self.upload(file_field=file_field) for file_field in file_fields])
+        if len(file_fields) == 1:
+            await self.upload(file_field=file_fields[0])
+            return
+        await gather_limited([self.upload(file_field=file_field) for file_field in file_fields],
+                             self.config.get('max_concurrent_uploads'))
 
     @property
     def store(self) -> Store:
@@ -240,16 +370,11 @@ class FastStore:
             if not isinstance(value, FileData):
                 logger.error(f'Expected FileData instance, got {type(value)} in {self.__class__.__name__}')
                 return
-            if self.file_count == 1:
-                if value.status:
+            if value.status:
+                self._store.files[value.field_name].append(value)
+                if self.file_count == 1:
                     self._store.file = value
-                    self._store.files[f'{value.field_name}'].append(value)
-                else:
-                    self._store.failed[f'{value.field_name}'].append(value)
             else:
-                if value.status:
-                    self._store.files[f'{value.field_name}'].append(value)
-                else:
-                    self._store.failed[f'{value.field_name}'].append(value)
+                self._store.failed[value.field_name].append(value)
         except Exception as err:
             logger.error(f'Error setting Store in {self.__class__.__name__}: {err}')
\ No newline at end of file
@@ -21,5 +21,7 @@ class MemoryStorage(FastStore):
             self.store = file_data
         except FileStoreError as err:
             logger.error(f'Error Saving file to Memory: {err} in {self.__class__.__name__}')
-            self.store = FileData(status=False, error='Something went wrong', field_name=file_field['name'],
-                                  message=f'Unable to upload {file_field["name"]}')
\ No newline at end of file
+            await file_field['file'].close()
+            self.store = FileData.model_construct(status=False, error='Something went wrong',
+                                                  field_name=file_field['name'],
+                                                  message=f'Unable to upload {file_field["name"]}')
\ No newline at end of file
@@ -12,10 +12,7 @@ logger = getLogger(__name__)
 
 class S3Storage(FastStore):
     """
-    Amazon S3 storage for FastAPI.
-
-    Properties:
-        client (boto3.client): The S3 client.
+    Amazon S3 storage for FastAPI. The S3 client is provided by the S3Engine.
     """
     StorageEngine = S3Engine
 
@@ -34,5 +31,7 @@ class S3Storage(FastStore):
             self.store = file_data
         except FileStoreError as err:
             logger.error(f'Error uploading file: {err} in {self.__class__.__name__}')
-            self.store = FileData(status=False, error='Something went wrong', field_name=file_field['name'],
-                                  message=f'Unable to upload {file_field["name"]}')
\ No newline at end of file
+            await file_field['file'].close()
+            self.store = FileData.model_construct(status=False, error='Something went wrong',
+                                                  field_name=file_field['name'],
+                                                  message=f'Unable to upload {file_field["name"]}')
\ No newline at end of file
@@ -1,17 +1,252 @@
 """
 This module contains the LocalStorage class.
 """
+import os
+import errno
+from functools import lru_cache
 from pathlib import Path
-from typing import Union
+from typing import Union, BinaryIO, List, Tuple, Callable, Awaitable, Optional
 from logging import getLogger
 
 from fastapi import UploadFile
 
+from ..blob_cache import blob_cache, file_digest
 from ..exceptions import FileStoreError
-from ..structs import FileField, FileData
-from .storage_engine import StorageEngine
+from ..structs import FileField, FileData, EMPTY_CONFIG
+from .storage_engine import StorageEngine, CHUNK_SIZE, run_in_executor
 
 logger = getLogger(__name__)
+WRITEV_SIZE = 1024 * 1024
+IOV_MAX = 1024
+_UNSUPPORTED = {errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.ENOTSOCK, errno.EOPNOTSUPP}
+
+
+def _copy_file_range(src_fd: int, dst_fd: int, offset: int, count: int) -> int:
+    return os.copy_file_range(src_fd, dst_fd, count, offset)
+
+
+def _sendfile(src_fd: int, dst_fd: int, offset: int, count: int) -> int:
+    return os.sendfile(dst_fd, src_fd, offset, count)
+
+
+_KERNEL_COPIES = tuple(copy for name, copy in (('copy_file_range', _copy_file_range), ('sendfile', _sendfile))
+                       if hasattr(os, name))
+
+
+def _open(dest, buffering: int = -1) -> BinaryIO:
+    """Open the destination for writing. The directories of destinations are created once and cached by _make_dirs, so
+    if the directory has been removed since then, for example by a cleanup job, it is created again.
+
+    Args:
+        dest (Path): The destination to open.
+        buffering (int): The buffering policy passed to open.
+
+    Returns:
+        BinaryIO: The file object of the destination.
+    """
+    try:
+        return open(f'{dest}', 'wb', buffering=buffering)
+    except FileNotFoundError:
+        Path(dest).parent.mkdir(parents=True, exist_ok=True)
+        return open(f'{dest}', 'wb', buffering=buffering)
+
+
+def _kernel_copy(src: BinaryIO, dest) -> bool:
+    """Copy a file that has been rolled over to disk to the destination without passing the bytes through user space.
+    os.copy_file_range is tried first, then os.sendfile. A method that fails or copies nothing before any bytes are
+    copied gives way to the next one. The copies read the source at explicit offsets and don't move its position, so
+    when the copy can't be completed the destination is rewritten from the same position by the fallback.
+
+    Args:
+        src (BinaryIO): The file object of the uploaded file. It must have a file descriptor.
+        dest (Path): The destination to copy the file to.
+
+    Returns:
+        bool: True if the whole file was copied, False if it could not be copied within the kernel.
+    """
+    src.flush()
+    src_fd, start = src.fileno(), src.tell()
+    size = os.fstat(src_fd).st_size
+    with _open(dest) as fh:
+        dst_fd = fh.fileno()
+        for copy in _KERNEL_COPIES:
+            offset = start
+            try:
+                while offset < size:
+                    sent = copy(src_fd, dst_fd, offset, size - offset)
+                    if not sent:
+                        break
+                    offset += sent
+            except OSError as err:
+                if offset != start or err.errno not in _UNSUPPORTED:
+                    raise
+            if offset == size:
+                return True
+            if offset != start:
+                # the copy stopped part way through, the destination has bytes the next method would append to
+                return False
+    return False
+
+
+def _writev(fd: int, bufs: List[bytes]):
+    """Write a list of buffers to a file descriptor with os.writev, retrying until every byte has been written.
+
+    Args:
+        fd (int): The file descriptor to write to.
+        bufs (list[bytes]): The buffers to write.
+    """
+    while bufs:
+        written = os.writev(fd, bufs)
+        start = 0
+        while start < len(bufs) and written >= len(bufs[start]):
+            written -= len(bufs[start])
+            start += 1
+        bufs = bufs[start:]
+        if written:
+            bufs[0] = memoryview(bufs[0])[written:]
+
+
+def _write_chunks(src: BinaryIO, dest, chunk_size: int):
+    """Write the content of the file object to the destination in chunks of chunk_size bytes. Where os.writev is
+    available the chunks are gathered and flushed with a single syscall for every WRITEV_SIZE bytes.
+
+    Args:
+        src (BinaryIO): The file object of the uploaded file.
+        dest (Path): The destination to write the file to.
+        chunk_size (int): The size of each chunk read from the file.
+    """
+    with _open(dest, buffering=0) as fh:
+        if not hasattr(os, 'writev'):
+            while chunk := src.read(chunk_size):
+                # unbuffered writes can be short, so write until the whole chunk is written
+                view = memoryview(chunk)
+                while view:
+                    view = view[fh.write(view):]
+            return
+
+        fd, bufs, total = fh.fileno(), [], 0
+        while chunk := src.read(chunk_size):
+            bufs.append(chunk)
+            total += len(chunk)
+            if total >= WRITEV_SIZE or len(bufs) >= IOV_MAX:
+                _writev(fd, bufs)
+                bufs, total = [], 0
+        _writev(fd, bufs)
+
+
+def _stat(path: str) -> Tuple[str, int, int]:
+    """Get the path, modification time and size of a stored file, used to tell if it has changed since it was stored."""
+    stat = os.stat(path)
+    return path, stat.st_mtime_ns, stat.st_size
+
+
+def _link(blob: Tuple[str, int, int], dest) -> bool:
+    """Hard link the destination to a previously stored file with the same content.
+
+    Args:
+        blob (tuple[str, int, int]): The path, modification time and size of the stored file.
+        dest (Path): The destination of the new file.
+
+    Returns:
+        bool: True if the destination now has the content, False if the stored file has changed or can't be linked.
+    """
+    try:
+        if _stat(blob[0]) != blob:
+            return False
+        if os.path.lexists(dest):
+            if os.path.samefile(blob[0], dest):
+                return True
+            os.unlink(dest)
+        os.link(blob[0], dest)
+        return True
+    except OSError:
+        return False
+
+
+def _unlink(path):
+    """Remove a file if it exists."""
+    if os.path.lexists(path):
+        os.unlink(path)
+
+
+def _save(src: BinaryIO, dest, chunk_size: int):
+    """Write the file to the destination. If the file has been rolled over to disk it is copied within the kernel,
+    otherwise it is streamed to the destination in chunks of chunk_size bytes. The whole save is a single blocking call,
+    so it costs one thread pool dispatch per file.
+
+    Args:
+        src (BinaryIO): The file object of the uploaded file.
+        dest (Path): The destination to save the file to.
+        chunk_size (int): The size of each chunk read from the file.
+    """
+    if not (getattr(src, '_rolled', False) and _kernel_copy(src, dest)):
+        _write_chunks(src, dest, chunk_size)
+
+
+def _store(blob: Optional[Tuple[str, int, int]], src: BinaryIO, dest, chunk_size: int) -> Tuple[str, int, int]:
+    """Store a file for dedupe. The destination is hard linked to the previously stored blob if possible, otherwise the
+    file is saved to it.
+
+    Args:
+        blob (tuple[str, int, int] | None): The path, modification time and size of the stored file, if any.
+        src (BinaryIO): The file object of the uploaded file.
+        dest (Path): The destination to save the file to.
+        chunk_size (int): The size of each chunk read from the file.
+
+    Returns:
+        tuple[str, int, int]: The path, modification time and size of the stored destination.
+    """
+    if not (blob and _link(blob, dest)):
+        # unlink first so that a file sharing the inode of an existing destination isn't overwritten
+        _unlink(dest)
+        _save(src, dest, chunk_size)
+    return _stat(str(dest))
+
+
+@lru_cache(maxsize=4096)
+def _make_dirs(destination: Union[str, Path]) -> Path:
+    """Resolve a destination directory and create it and its parents. Relative destinations are resolved against the
+    current working directory. This is cached so that each destination is only resolved and created once per process
+    instead of once per uploaded file, so changing the working directory afterwards doesn't move a destination that
+    has already been used.
+
+    Args:
+        destination (str | Path): The destination directory.
+
+    Returns:
+        Path: The resolved destination directory.
+    """
+    path = destination if isinstance(destination, Path) else Path.cwd() / destination
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+@lru_cache(maxsize=1024)
+def _path_resolver(destination: Union[str, Path]) -> Callable[['LocalEngine', str, UploadFile], Awaitable[Path]]:
+    """Get the resolver of a str or Path destination. It is cached so that the same resolver is reused for each file
+    saved to the destination."""
+    async def resolve(engine, field_name, file):
+        return engine.get_path(file, destination)
+    return resolve
+
+
+def _resolver(destination: Union[str, Path, Callable]) -> Callable[['LocalEngine', str, UploadFile], Awaitable[Path]]:
+    """Get the function that resolves the path to save a file to for a destination. Resolvers of str and Path
+    destinations are cached, callable destinations are not, since they may not be hashable and caching them would
+    keep closures made per request alive for the life of the process.
+
+    Args:
+        destination (str | Path | Callable): The destination from the config.
+
+    Returns:
+        Callable[[LocalEngine, str, UploadFile], Awaitable[Path]]: A coroutine function that takes the engine, the
+            field name and the file and returns the path to save the file to.
+    """
+    if callable(destination):
+        async def resolve(engine, field_name, file):
+            return await engine.run_callback(destination, field_name, file)
+        return resolve
+    return _path_resolver(destination)
 
 
 class LocalEngine(StorageEngine):
@@ -23,28 +258,33 @@ class LocalEngine(StorageEngine):
         Returns:
             Path: The path to save the file to.
         """
-        if isinstance(destination, Path):
-            Path(destination).mkdir(parents=True, exist_ok=True) if not destination.exists() else ...
-        else:
-            destination = Path.cwd() / destination
-            Path(destination).mkdir(parents=True, exist_ok=True) if not destination.exists() else ...
-        return destination / file.filename
+        return _make_dirs(destination) / file.filename
 
     @staticmethod
-    async def _upload(file: UploadFile, dest):
+    async def _upload(file: UploadFile, dest, chunk_size: int = CHUNK_SIZE, dedupe: bool = False):
         """Private method to upload the file to the destination. This method is called by the upload method.
+        With dedupe, content that was saved before is hard linked to the destination instead of being written again.
 
         Args:
             file (UploadFile): The file to upload.
             dest (Path): The destination to upload the file to.
+            chunk_size (int): The size of each chunk read from the file.
+            dedupe (bool): Hard link files with the same content instead of writing them again.
 
         Returns:
             None: Nothing is returned.
         """
-        file_object = await file.read()
-        with open(f'{dest}', 'wb') as fh:
-            fh.write(file_object)
-        await file.close()
+        try:
+            if dedupe:
+                async def store(blob):
+                    return await run_in_executor(_store, blob, file.file, dest, chunk_size)
+
+                digest = await run_in_executor(file_digest, file.file, chunk_size)
+                await blob_cache.get_or_put(digest, store)
+            else:
+                await run_in_executor(_save, file.file, dest, chunk_size)
+        finally:
+            await file.close()
 
     async def upload(self, file_field=None) -> FileData:
         """Upload a file to the destination.
@@ -56,18 +296,18 @@ class LocalEngine(StorageEngine):
             None: Nothing is returned.
         """
         try:
-            self.file_field = file_field
-            field_name, file = self.file_field['name'], self.file_field['file']
-            dest = self.config.get('destination', None)
-            dest = dest(self.request, self.form, field_name, file) if callable(dest) else self.get_path(file, dest)
-            if self.config['background']:
-                self.background_tasks.add_task(self._upload, file, dest)
+            file_field = file_field or self.file_field
+            field_name, file, config = file_field['name'], file_field['file'], file_field.get('config', EMPTY_CONFIG)
+            dest = await _resolver(config.get('destination', None))(self, field_name, file)
+            chunk_size, dedupe = config.get('chunk_size', CHUNK_SIZE), config.get('dedupe', False)
+            if config['background']:
+                self.background_tasks.add_task(self._upload, file, dest, chunk_size, dedupe)
                 message = f'{file.filename} is saving in the background'
             else:
-                await self._upload(file, dest)
+                await self._upload(file, dest, chunk_size, dedupe)
                 message = f'{file.filename} was saved successfully'
-            return FileData(size=file.size, filename=file.filename, content_type=file.content_type,
-                            path=str(dest), field_name=field_name, message=message)
+            return FileData.model_construct(size=file.size, filename=file.filename, content_type=file.content_type,
+                                            path=str(dest), field_name=field_name, message=message)
         except Exception as err:
             logger.error(f'Error uploading file: {err} in {self.__class__.__name__}')
             raise FileStoreError(err)
\ No newline at end of file
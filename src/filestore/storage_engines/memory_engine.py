@@ -5,7 +5,7 @@ from logging import getLogger
 
 from fastapi import UploadFile
 
-from .storage_engine import StorageEngine
+from .storage_engine import StorageEngine, run_in_executor
 from ..structs import FileField, FileData
 from ..exceptions import FileStoreError
 
@@ -17,13 +17,18 @@ class MemoryEngine(StorageEngine):
 
     async def upload(self, file_field: FileField = None) -> FileData:
         try:
-            self.file_field = file_field
-            file = self.file_field['file']
-            obj = await file.read()
-            await file.close()
-            return FileData(size=file.size, filename=file.filename, content_type=file.content_type,
-                            field_name=file_field['name'], file=obj,
-                            message=f'{file.filename} saved successfully')
+            file_field = file_field or self.file_field
+            file = file_field['file']
+            try:
+                # a single read sizes its buffer from the file, so the content is copied once instead of being
+                # gathered in chunks and joined. Files rolled over to disk are read in the engine thread pool.
+                obj = await run_in_executor(file.file.read) if getattr(file.file, '_rolled', False) \
+                    else file.file.read()
+            finally:
+                await file.close()
+            return FileData.model_construct(size=file.size, filename=file.filename, content_type=file.content_type,
+                                            field_name=file_field['name'], file=obj,
+                                            message=f'{file.filename} saved successfully')
         except Exception as err:
             logger.error(f'Error Saving file to Memory: {err} in {self.__class__.__name__}')
             raise FileStoreError(err)
\ No newline at end of file
@@ -1,88 +1,193 @@
 """AWS S3 storage for FastAPI. This module contains the S3Storage class which is used to upload files to Amazon S3."""
 
 import os
+import re
 import asyncio
-from typing import BinaryIO
-from urllib.parse import quote as urlencode
+from typing import BinaryIO, Union, Callable, Awaitable, Optional
+from urllib.parse import quote_from_bytes
 from logging import getLogger
-try:
-    from functools import cache
-except ImportError:
-    from functools import lru_cache
-    cache = lru_cache(maxsize=None)
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
 
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config as ClientConfig
+from botocore.exceptions import ClientError
 
+from ..blob_cache import file_digest
 from ..exceptions import FileStoreError
-from ..structs import FileField, UploadFile, FileData
-from .storage_engine import StorageEngine
+from ..structs import FileField, UploadFile, FileData, EMPTY_CONFIG
+from .storage_engine import StorageEngine, CHUNK_SIZE
 
 logger = getLogger(__name__)
+TRANSFER_CONFIG = TransferConfig(multipart_threshold=8 * 1024 * 1024, multipart_chunksize=8 * 1024 * 1024,
+                                 max_concurrency=10, use_threads=True)
+S3_THREAD_POOL_SIZE = int(os.environ.get('FILESTORE_S3_THREAD_POOL_SIZE', 32))
+# each upload thread can send up to max_concurrency parts of a multipart upload at once, so the connection pool is
+# sized for all of them. Payloads are sent over HTTPS, so don't read the body an extra time to sign its sha256
+CLIENT_CONFIG = ClientConfig(max_pool_connections=S3_THREAD_POOL_SIZE * TRANSFER_CONFIG.max_concurrency,
+                             retries={'mode': 'adaptive'}, s3={'payload_signing_enabled': False})
+_UNSAFE_KEY = re.compile(r'[^A-Za-z0-9/_.~-]')
+DIGEST_KEY = 'sha256'
+_executor = None
+
+
+def get_executor() -> ThreadPoolExecutor:
+    """Get the thread pool for S3 uploads. It is created on first use with S3_THREAD_POOL_SIZE workers, which can be
+    set with the FILESTORE_S3_THREAD_POOL_SIZE environment variable. The connection pool of the clients has room for
+    the max_concurrency part uploads of TRANSFER_CONFIG in every worker, so uploads don't wait on each other for a
+    connection."""
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=S3_THREAD_POOL_SIZE, thread_name_prefix='filestore-s3')
+    return _executor
+
+
+@lru_cache(maxsize=8)
+def get_client(region_name: Optional[str] = None):
+    """
+    Get the S3 client for a region. Clients are thread safe, so one client is created per region and shared by all
+    engines and requests, along with its connection pool. Make sure the AWS credentials are set in the environment
+    variables.
 
+    Args:
+        region_name (str | None): The name of the region.
 
-async def make_async(func, *args, **kwargs):
-    return func(*args, **kwargs)
+    Returns:
+        boto3.client: The S3 client.
+    """
+    key_id = os.environ.get('AWS_ACCESS_KEY_ID')
+    access_key = os.environ.get('AWS_SECRET_ACCESS_KEY')
+    return boto3.client('s3', region_name=region_name, aws_access_key_id=key_id, aws_secret_access_key=access_key,
+                        config=CLIENT_CONFIG)
+
+
+@lru_cache(maxsize=1024)
+def _path_resolver(destination: str) -> Callable[['S3Engine', str, UploadFile], Awaitable[str]]:
+    """Get the resolver of a str destination. It is cached so that the same resolver is reused for each file uploaded
+    to the destination."""
+    if destination:
+        async def resolve(engine, field_name, file):
+            return f'{destination}/{file.filename}'
+    else:
+        async def resolve(engine, field_name, file):
+            return file.filename
+    return resolve
+
+
+def _resolver(destination: Union[str, Callable]) -> Callable[['S3Engine', str, UploadFile], Awaitable[str]]:
+    """Get the function that resolves the object name of a file for a destination. Resolvers of str destinations are
+    cached, callable destinations are not, since they may not be hashable and caching them would keep closures made
+    per request alive for the life of the process.
+
+    Args:
+        destination (str | Callable): The destination from the config.
+
+    Returns:
+        Callable[[S3Engine, str, UploadFile], Awaitable[str]]: A coroutine function that takes the engine, the field
+            name and the file and returns the object name.
+    """
+    if callable(destination):
+        async def resolve(engine, field_name, file):
+            return await engine.run_callback(destination, field_name, file)
+        return resolve
+    return _path_resolver(destination)
+
+
+def _quote_key(key: str) -> str:
+    """Percent encode an object key for use in a URL. Keys made only of URL safe characters, the common case, are
+    returned as they are."""
+    return quote_from_bytes(key.encode('utf8')) if _UNSAFE_KEY.search(key) else key
+
+
+def _is_stored(client, bucket: str, obj_name: str, digest: str) -> bool:
+    """Check if an object with the given sha256 digest of its content already exists under the key. S3 answers a
+    HEAD request for a missing key with 403 instead of 404 when the caller may not list the bucket, so a 403 is
+    treated as not stored and the file is uploaded."""
+    try:
+        head = client.head_object(Bucket=bucket, Key=obj_name)
+    except ClientError as err:
+        code = err.response.get('Error', {}).get('Code')
+        if code in ('404', 'NoSuchKey', 'NotFound'):
+            return False
+        if code in ('403', 'AccessDenied', 'Forbidden'):
+            logger.warning(f'Access denied checking if {obj_name} is stored in {bucket}, uploading it')
+            return False
+        raise
+    return head.get('Metadata', {}).get(DIGEST_KEY) == digest
+
+
+def _upload_fileobj(client, file_obj: BinaryIO, bucket: str, obj_name: str, extra_args: Optional[dict],
+                    dedupe: bool = False) -> bool:
+    """Upload a file object with upload_fileobj and close it afterwards, so the spooled temporary file of the upload
+    is released as soon as it has been sent. With dedupe, the sha256 digest of the content is stored in the object
+    metadata, and the upload is skipped if the object already exists with the same digest.
+
+    Returns:
+        bool: True if the file was uploaded, False if the upload was skipped.
+    """
+    try:
+        if dedupe:
+            digest = file_digest(file_obj, CHUNK_SIZE)
+            if _is_stored(client, bucket, obj_name, digest):
+                return False
+            extra_args = extra_args or {}
+            extra_args = {**extra_args, 'Metadata': {**extra_args.get('Metadata', {}), DIGEST_KEY: digest}}
+        client.upload_fileobj(file_obj, bucket, obj_name, ExtraArgs=extra_args, Config=TRANSFER_CONFIG)
+        return True
+    finally:
+        file_obj.close()
 
 
 class S3Engine(StorageEngine):
     """Amazon S3 storage for FastAPI.
 
+    Attributes:
+        bucket (str): The default bucket, read from the AWS_BUCKET_NAME environment variable.
+        region (str): The default region, read from the AWS_DEFAULT_REGION environment variable.
+
     Properties:
         client (boto3.client): The S3 client.
     """
 
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        # read the environment once per engine instead of once per uploaded file
+        self.bucket = os.environ.get('AWS_BUCKET_NAME')
+        self.region = os.environ.get('AWS_DEFAULT_REGION')
+
     @property
-    @cache
     def client(self):
         """
-        Get the S3 client. Make sure the AWS credentials are set in the environment variables.
-        This property is cached.
+        Get the S3 client for the region of the engine, the region in the config or else the AWS_DEFAULT_REGION. The
+        client is shared, see get_client.
 
         Returns:
             boto3.client: The S3 client.
         """
-        key_id = os.environ.get('AWS_ACCESS_KEY_ID')
-        access_key = os.environ.get('AWS_SECRET_ACCESS_KEY')
-        region_name = os.environ.get('AWS_DEFAULT_REGION') or self.config.get('region')
-        return boto3.client('s3', region_name=region_name, aws_access_key_id=key_id, aws_secret_access_key=access_key)
-
-    async def _upload(self, *, file_obj: BinaryIO, bucket: str, obj_name: str, extra_args: dict) -> dict:
-        """
-        Private method to upload the file to the destination. This method is called by the upload method.
-
-        Args:
-            file_obj (BinaryIO): The file object to upload.
-            bucket (str): The name of the bucket to upload the file to.
-            obj_name (str): The name of the object.
-            extra_args (dict): Extra arguments to pass to the put_object method.
-
-        Returns:
-            None: Nothing is returned.
-        """
-        try:
-            return await asyncio.to_thread(self.client.put_object, Body=file_obj, Bucket=bucket, Key=obj_name, **extra_args)
-        except AttributeError:
-            return await make_async(self.client.put_object, Body=file_obj, Bucket=bucket, Key=obj_name, **extra_args)
+        return get_client(self.config.get('region') or self.region)
 
-    async def _background_upload(self, *, file_obj: BinaryIO, bucket: str, obj_name: str,
-                                 extra_args: dict) -> UploadFile:
+    async def _upload(self, *, client, file_obj: BinaryIO, bucket: str, obj_name: str, extra_args: Optional[dict],
+                      dedupe: bool = False) -> bool:
         """
-        Private method to upload the file to the destination. This method is called by the upload method for background
-        tasks. Uses upload_fileobj method to upload the file. This allows the file to be uploaded in chunks.
+        Private method to upload the file to the destination. This method is called by the upload method, or scheduled
+        as a background task when the background config is set. Uses the upload_fileobj method so the file is streamed
+        from its file handle and sent as a multipart upload once it is larger than the multipart threshold of
+        TRANSFER_CONFIG.
 
         Args:
+            client (boto3.client): The S3 client.
             file_obj (BinaryIO): The file object to upload.
             bucket (str): The name of the bucket to upload the file to.
             obj_name (str): The name of the object.
-            extra_args (dict): Extra arguments to pass to the put_object method.
+            extra_args (dict): Extra arguments to pass to the upload_fileobj method.
+            dedupe (bool): Skip the upload if the object already exists with the same content.
 
         Returns:
-            None: Nothing is returned.
+            bool: True if the file was uploaded, False if the upload was skipped.
         """
-        try:
-            return await asyncio.to_thread(self.client.upload_fileobj, file_obj, bucket, obj_name, ExtraArgs=extra_args)
-        except AttributeError:
-            return await make_async(self.client.upload_fileobj, file_obj, bucket, obj_name, ExtraArgs=extra_args)
+        return await asyncio.get_running_loop().run_in_executor(
+            get_executor(), partial(_upload_fileobj, client, file_obj, bucket, obj_name, extra_args, dedupe))
 
     # noinspection PyTypeChecker
     async def upload(self, *, file_field: FileField = None) -> FileData:
@@ -95,29 +200,26 @@ class S3Engine(StorageEngine):
             None: Nothing is returned.
         """
         try:
-            self.file_field = file_field
-            field_name, file = self.file_field['name'], self.file_field['file']
-            dest = self.config.get('destination', '')
-            object_name = dest(self.request, self.form, field_name, file) if callable(dest) else \
-                (f'{dest}/{file.filename}' if dest else file.filename)
-            bucket = self.config.get('bucket') or os.environ.get('AWS_BUCKET_NAME')
-            region = self.config.get('region') or os.environ.get('AWS_DEFAULT_REGION')
-            extra_args = self.config.get('extra_args', {})
-            msg, meta = '', {}
-            if self.config.get('background'):
-                self.background_tasks.add_task(self._background_upload, file_obj=file.file, bucket=bucket,
-                                               obj_name=object_name, extra_args=extra_args)
-                msg = f'{file.filename} uploading in background'
+            file_field = file_field or self.file_field
+            field_name, file, config = file_field['name'], file_field['file'], file_field.get('config', EMPTY_CONFIG)
+            object_name = await _resolver(config.get('destination', ''))(self, field_name, file)
+            # the region in the config overrides the default one, for both the client and the url of the object
+            bucket, region = config.get('bucket') or self.bucket, config.get('region') or self.region
+            client = get_client(region)
+            extra_args, dedupe = config.get('extra_args'), config.get('dedupe', False)
+            if config.get('background'):
+                self.background_tasks.add_task(self._upload, client=client, file_obj=file.file, bucket=bucket,
+                                               obj_name=object_name, extra_args=extra_args, dedupe=dedupe)
+                msg, meta = f'{file.filename} uploading in background', {}
             else:
-                res = await self._upload(file_obj=file.file, bucket=bucket, obj_name=object_name,
-                                         extra_args=extra_args)
-                if (meta := res.get('ResponseMetadata', {})).get('HTTPStatusCode', 0) == 200:
-                    msg = f'{file.filename} successfully uploaded'
-                else:
-                    msg = f'Error uploading {file.filename}'
-            url = f"https://{bucket}.s3.{region}.amazonaws.com/{urlencode(object_name.encode('utf8'))}"
-            return FileData(filename=file.filename, size=file.size, content_type=file.content_type,
-                            field_name=field_name, url=url, message=msg, metadata=meta)
+                uploaded = await self._upload(client=client, file_obj=file.file, bucket=bucket, obj_name=object_name,
+                                              extra_args=extra_args, dedupe=dedupe)
+                # upload_fileobj doesn't return the response of the upload, so there is no metadata to report
+                msg = f'{file.filename} successfully uploaded' if uploaded else f'{file.filename} already uploaded'
+                meta = {}
+            url = f"https://{bucket}.s3.{region}.amazonaws.com/{_quote_key(object_name)}"
+            return FileData.model_construct(filename=file.filename, size=file.size, content_type=file.content_type,
+                                            field_name=field_name, url=url, message=msg, metadata=meta)
         except Exception as err:
             logger.error(f'Error uploading file: {err} in {self.__class__.__name__}')
             raise FileStoreError(err)
\ No newline at end of file
@@ -1,9 +1,44 @@
+import os
 import asyncio
+import inspect
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from abc import abstractmethod, ABC
+from typing import Callable, Any
 
 from fastapi import BackgroundTasks, Request
+from starlette.concurrency import run_in_threadpool
 
-from ..structs import FileField, Config, FormData, List, UploadFile, FileData
+from ..util import gather_limited
+from ..structs import FileField, Config, FormData, List, UploadFile, FileData, EMPTY_CONFIG
+
+CHUNK_SIZE = 1024 * 64
+THREAD_POOL_SIZE = int(os.environ.get('FILESTORE_THREAD_POOL_SIZE', 64))
+_executor = None
+
+
+def get_executor() -> ThreadPoolExecutor:
+    """Get the thread pool shared by the storage engines for blocking file I/O. It is created on first use with
+    THREAD_POOL_SIZE workers, which can be set with the FILESTORE_THREAD_POOL_SIZE environment variable. Disk writes
+    run in this pool instead of the default threadpool, so they don't queue behind other blocking work of the app."""
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=THREAD_POOL_SIZE, thread_name_prefix='filestore')
+    return _executor
+
+
+async def run_in_executor(func: Callable, *args, **kwargs) -> Any:
+    """Run a blocking function in the shared storage engine thread pool.
+
+    Args:
+        func (Callable): The function to run.
+        *args: Positional arguments for the function.
+        **kwargs: Keyword arguments for the function.
+
+    Returns:
+        Any: The return value of the function.
+    """
+    return await asyncio.get_running_loop().run_in_executor(get_executor(), partial(func, *args, **kwargs))
 
 
 class StorageEngine(ABC):
@@ -13,20 +48,29 @@ class StorageEngine(ABC):
         self.form = form
         self.request = request
         self.background_tasks = background_tasks
-        self._file_field = file_field or {}
+        self.file_field: FileField = file_field or {}
 
     @property
     def config(self) -> Config:
-        return self.file_field.get('config', {})
+        return self.file_field.get('config', EMPTY_CONFIG)
 
-    @property
-    def file_field(self):
-        return self._file_field
+    async def run_callback(self, func: Callable, field_name: str, file: UploadFile) -> Any:
+        """
+        Run a config callback, such as a destination function, with the request, form, field name and file.
+        Coroutine functions are awaited, regular functions are run in a worker thread so that blocking calls made by
+        them don't block the event loop.
+
+        Args:
+            func (Callable): The callback function.
+            field_name (str): The name of the form field.
+            file (UploadFile): The file object.
 
-    @file_field.setter
-    def file_field(self, file_field: dict):
-        file_field = file_field or {}
-        self._file_field = file_field.copy() or self.file_field
+        Returns:
+            Any: The return value of the callback.
+        """
+        if inspect.iscoroutinefunction(func):
+            return await func(self.request, self.form, field_name, file)
+        return await run_in_threadpool(func, self.request, self.form, field_name, file)
 
     @abstractmethod
     async def upload(self, *, file_field) -> FileData:
@@ -34,4 +78,7 @@ class StorageEngine(ABC):
 
     async def multi_upload(self, *, file_fields: List[FileField]) -> List[FileData]:
         """"""
-        return await asyncio.gather(*[self.upload(file_field=file_field) for file_field in file_fields])
\ No newline at end of file
+        if len(file_fields) == 1:
+            return [await self.upload(file_field=file_fields[0])]
+        limit = file_fields[0].get('config', EMPTY_CONFIG).get('max_concurrent_uploads')
+        return await gather_limited([self.upload(file_field=file_field) for file_field in file_fields], limit)
\ No newline at end of file
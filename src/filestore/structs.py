@@ -2,12 +2,14 @@
 
 from typing import Any, Type, cast, TypeVar, Callable, Union, List, Dict
 from pathlib import Path
+from types import MappingProxyType
 from logging import getLogger
 from collections import defaultdict
+from functools import partial
 
 from starlette.datastructures import UploadFile as StarletteUploadFile, FormData
 from fastapi import Request, UploadFile as UF, Form
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 
 try:
     td = True
@@ -17,13 +19,6 @@ except ImportError:
     Config = TypeVar('Config', bound=dict)
     FileField = TypeVar('FileField', bound=dict)
 
-try:
-    from functools import cache
-except ImportError as err:
-    from functools import lru_cache
-
-    cache = lru_cache(maxsize=None)
-
 logger = getLogger(__name__)
 NoneType = type(None)
 StorageEngine = TypeVar('StorageEngine', bound='StorageEngine')
@@ -50,10 +45,18 @@ if td:
         """
         destination: Union[Callable[[Request, Form, str, UploadFile], Union[str, Path]], str, Path]
         filter: Callable[[Request, Form, str, UploadFile], bool]
+        max_filesize: int
         max_files: int
         max_fields: int
+        threaded_parse: bool
+        spool_max_size: int
+        max_concurrent_uploads: int
         filename: Callable[[Request, Form, str, UploadFile], UploadFile]
+        threaded_filter: bool
+        threaded_filename: bool
         background: bool
+        chunk_size: int
+        dedupe: bool
         extra_args: dict
         bucket: str
         region: str
@@ -72,6 +75,9 @@ if td:
         storage: StorageEngine
 
 
+# a shared read-only empty config for fields without one, so a new empty dict is not created for each lookup
+EMPTY_CONFIG: Config = MappingProxyType({})
+
 Self = TypeVar('Self', bound='FastStore')
 
 
@@ -119,8 +125,8 @@ class Store(BaseModel):
         message (str): Success message if the file storage operation was successful.
     """
     file: Union[FileData, NoneType] = None
-    files: Dict[str, List[FileData]] = defaultdict(list)
-    failed: Dict[str, List[FileData]] = defaultdict(list)
+    files: Dict[str, List[FileData]] = Field(default_factory=partial(defaultdict, list))
+    failed: Dict[str, List[FileData]] = Field(default_factory=partial(defaultdict, list))
     error: str = ''
     message: str = ''
     status: bool = True
@@ -1,4 +1,5 @@
-from typing import Any, Set, Dict, Type
+import asyncio
+from typing import Any, Set, Dict, Type, Awaitable, List, Optional, Sequence
 
 from pydantic.json_schema import GenerateJsonSchema, JsonSchemaWarningKind, DEFAULT_REF_TEMPLATE, JsonSchemaMode
 from pydantic import BaseModel, ConfigDict
@@ -21,3 +22,44 @@ class FormModel(BaseModel):
     ) -> Dict[str, Any]:
         return super().model_json_schema(by_alias=by_alias, ref_template=ref_template,
                                          schema_generator=schema_generator, mode=mode)
+
+
+async def gather_limited(aws: Sequence[Awaitable], limit: Optional[int] = None) -> List[Any]:
+    """
+    Run awaitables concurrently like asyncio.gather, but with at most limit of them running at a time. Only limit
+    worker tasks are created, each awaiting the next pending awaitable until none are left. Unlike asyncio.gather, if
+    one of the awaitables fails or the call is cancelled, the others are cancelled instead of being left running.
+
+    Args:
+        aws (Sequence[Awaitable]): The awaitables to run.
+        limit (int | None): The maximum number of awaitables to run at a time. None or 0 means no limit.
+
+    Returns:
+        list: The results of the awaitables in the order they were given.
+    """
+    loop = asyncio.get_running_loop()
+    if not limit or len(aws) <= limit:
+        pending = iter(())
+        tasks = [loop.create_task(aw) if asyncio.iscoroutine(aw) else asyncio.ensure_future(aw) for aw in aws]
+        results = None
+    else:
+        results: List[Any] = [None] * len(aws)
+        pending = iter(enumerate(aws))
+
+        async def worker():
+            for index, aw in pending:
+                results[index] = await aw
+
+        tasks = [loop.create_task(worker()) for _ in range(limit)]
+
+    try:
+        done = await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for _, aw in pending:
+            # close the coroutines that were never started, so they don't warn about never being awaited
+            getattr(aw, 'close', lambda: None)()
+        raise
+    return done if results is None else results
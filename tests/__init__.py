@@ -2,51 +2,81 @@
 This module sets up the test environment.
 All fixtures are defined here and can be used in any test file.
 """
+import os
+from io import BytesIO
 from pathlib import Path
 import random
-from string import ascii_letters, digits, whitespace
 
 from fastapi.testclient import TestClient
 from pytest import fixture
 
 from .app import app
 
-client = TestClient(app)
+
+class NamedBytesIO(BytesIO):
+    """An in-memory file with a name, uploaded by the test client just like a file opened from disk."""
+
+    def __init__(self, content: bytes, name: str):
+        super().__init__(content)
+        self.name = name
+
 
 @fixture(scope='session', autouse=True)
-def file():
+def file(tmp_path_factory):
+    """
+    Run the test session in a temporary directory. The storage instances of the app save uploads to destinations
+    relative to the working directory, so the uploads are written there and removed by pytest instead of being left
+    in the working tree.
     """
-    Create a test file with random content.
+    cwd = Path.cwd()
+    os.chdir(tmp_path_factory.mktemp('test_data'))
+    yield
+    os.chdir(cwd)
+
+
+@fixture(scope='session')
+def client() -> TestClient:
+    """
+    The test client shared by all the tests. It is entered once for the session, so the app's lifespan runs once and
+    every request goes through the same event loop, which is warmed up with a request for the OpenAPI schema.
+
     Yields:
-        file: A file reader object
+        TestClient: The test client
+    """
+    with TestClient(app) as test_client:
+        test_client.get('/openapi.json')
+        yield test_client
+
+
+@fixture(scope='session')
+def payload() -> bytes:
     """
-    test_dir = Path.cwd() / 'test_data'
-    test_dir.mkdir(parents=True, exist_ok=True) if not test_dir.exists() else ...
+    The random content of the test files, generated once for the whole test session.
+
+    Returns:
+        bytes: 1MB of random bytes
+    """
+    return os.urandom(1_000_000)
+
 
 @fixture
-def book_file():
+def book_file(payload):
     """
-    Create a test file with random content.
+    Create an in-memory test file with random content.
 
     Yields:
         file: A file reader object
     """
-    file = f'test_data/book{random.randint(1000, 9999)}.txt'
-    with open(file, 'w') as fh:
-        lines = [''.join(random.choices(ascii_letters + digits + whitespace, k=1000)) for _ in range(1000)]
-        fh.writelines(lines)
-    yield open(file, 'rb')
+    with NamedBytesIO(payload, f'test_data/book{random.randint(1000, 9999)}.txt') as fh:
+        yield fh
 
 
 @fixture
-def image_file():
+def image_file(payload):
     """
-    Create a test file with random content.
+    Create an in-memory test file with random content.
     Yields:
         file: A file reader object
     """
-    file = f'test_data/image{random.randint(1000, 9999)}.png'
-    with open(file, 'w') as fh:
-        lines = [''.join(random.choices(ascii_letters + digits + whitespace, k=1000)) for _ in range(1000)]
-        fh.writelines(lines)
-    yield open(file, 'rb')
\ No newline at end of file
+    with NamedBytesIO(payload, f'test_data/image{random.randint(1000, 9999)}.png') as fh:
+        yield fh
\ No newline at end of file
@@ -1,19 +1,27 @@
 """
 This module contains a test FastAPI application and the endpoints.
 """
-import base64
+import asyncio
 
 from fastapi import FastAPI, Request, Depends, UploadFile, File, Form, Response
 from typing import List, Union
 import uvicorn
 from fastapi.templating import Jinja2Templates
+from fastapi.responses import ORJSONResponse
 from dotenv import load_dotenv
-from base64 import b64encode
+from starlette.concurrency import run_in_threadpool
 from filestore import FileData, Store
-from .utils import single_local, multiple_local, single_mem, multiple_mem, single_s3, multiple_s3, filestore
+from .utils import (single_local, dedupe_local, multiple_local, single_mem, multiple_mem, max_size_mem, single_s3,
+                    multiple_s3, filestore)
+
+try:
+    from pybase64 import b64encode
+except ImportError:
+    from base64 import b64encode
+
 load_dotenv()
 
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
 
 templates = Jinja2Templates(directory='.')
 
@@ -41,6 +49,34 @@ async def local_single(model=Depends(single_local.model), loc=Depends(single_loc
     return loc.store
 
 
+@app.post('/local_form')
+async def local_form(loc=Depends(single_local)) -> Store:
+    """Local storage single file upload endpoint without the form model, the form is parsed by the LocalStorage instance.
+
+    Args:
+        loc (LocalStorage): The LocalStorage instance.
+
+    Returns:
+        Store: The result of the storage operation.
+    """
+    return loc.store
+
+
+@app.post('/local_dedupe')
+async def local_dedupe(model=Depends(dedupe_local.model), loc=Depends(dedupe_local)) -> Store:
+    """Local storage endpoint that hard links files with the same content.
+
+    Args:
+        model (FormModel): The form model dynamically built from the form file fields.
+            This only useful to swagger UI to show the form fields.
+        loc (LocalStorage): The LocalStorage instance.
+
+    Returns:
+        Store: The result of the storage operation.
+    """
+    return loc.store
+
+
 @app.post('/local_multiple', openapi_extra={'form': {'multiple': True}})
 async def local_multiple(model=Depends(multiple_local.model), loc=Depends(multiple_local)) -> Store:
     """Local storage multiple file upload endpoint.
@@ -52,7 +88,6 @@ async def local_multiple(model=Depends(multiple_local.model), loc=Depends(multip
     Returns:
         Store: The result of the storage operation.
     """
-    # print(type(loc))
     return loc.store
 
 
@@ -90,7 +125,7 @@ async def mem_single(model=Depends(single_mem.model), mem=Depends(single_mem)):
         Store: The result of the storage operation.
     """
     # img = f"""data:image/png;base64, {b64encode(mem.store.file.file).decode('utf-8')}"""
-    mem.store.file.file = b64encode(mem.store.file.file)
+    mem.store.file.file = await run_in_threadpool(b64encode, mem.store.file.file)
     return mem.store
 
 @app.post('/multiple_memory', name='multiple_memory')
@@ -106,12 +141,27 @@ async def mem_multiple(model=Depends(multiple_mem.model), mem=Depends(multiple_m
     Returns:
         Store: The result of the storage operation.
     """
-    for field in mem.store.files:
-        for filedata in mem.store.files[field]:
-            filedata.file = b64encode(filedata.file)
+    filedatas = [filedata for field in mem.store.files for filedata in mem.store.files[field]]
+    encoded = await asyncio.gather(*(run_in_threadpool(b64encode, filedata.file) for filedata in filedatas))
+    for filedata, file in zip(filedatas, encoded):
+        filedata.file = file
     return mem.store
 
 
+@app.post('/memory_max_size', name='memory_max_size')
+async def mem_max_size(mem=Depends(max_size_mem)) -> List[str]:
+    """
+    Memory storage endpoint with a max_filesize.
+
+    Args:
+        mem (MemoryStorage): The MemoryStorage instance.
+
+    Returns:
+        list[str]: The names of the stored files.
+    """
+    return [filedata.filename for files in mem.store.files.values() for filedata in files]
+
+
 @app.post('/filestore', name='filestore')
 async def filestore(model=Depends(filestore.model), files=Depends(filestore)) -> Union[FileData, List[FileData]]:
     return files
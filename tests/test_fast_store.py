@@ -4,16 +4,31 @@ All tests are run with pytest.
 
 Functions:
     test_local_single: Test single file upload to local storage
+    test_local_form: Test single file upload to local storage with the form parsed by FastStore
+    test_local_dedupe: Test files with the same content are hard linked in local storage
     test_local_multiple: Test multiple files upload to local storage
+    test_local_max_count: Test max_count applies to the files that pass the filter
     test_s3_single: Test single file upload to S3 storage
     test_s3_multiple: Test multiple files upload to S3 storage
     test_mem_single: Test single file upload to memory storage
     test_mem_multiple: Test multiple files upload to memory storage
+    test_mem_max_filesize: Test files larger than max_filesize are rejected before the filter runs
+    test_threaded_form: Test the threaded form parser gives the same form as Starlette's parser
+    test_spool_max_size: Test files larger than spool_max_size are rolled over to disk
 """
-from . import client, book_file, image_file, file
+import os
+import asyncio
 
+import httpx
+from starlette.requests import Request
 
-def test_s3_single(book_file):
+from filestore.formparsers import get_form
+
+from . import client, book_file, image_file, file, payload
+from .utils import FILTERED, MAX_SIZE
+
+
+def test_s3_single(client, book_file):
     """
     Test single file upload to S3 storage.
     All arguments are fixtures from __init__.
@@ -26,7 +41,7 @@ def test_s3_single(book_file):
     assert len([file for field in res['files'].values() for file in field]) == 1
 
 
-def test_s3_multiple(book_file, image_file):
+def test_s3_multiple(client, book_file, image_file):
     """
     Test multiple files upload to S3 storage.
     All arguments are fixtures from the __init__.
@@ -40,7 +55,7 @@ def test_s3_multiple(book_file, image_file):
     assert len([file for field in res['files'].values() for file in field]) == 4
 
 
-def test_local_single(book_file):
+def test_local_single(client, book_file):
     """Test single file upload to local storage. All arguments are fixtures from the __init__."""
     response = client.post('/local_single', files={'book': book_file})
     assert response.status_code == 200
@@ -50,7 +65,29 @@ def test_local_single(book_file):
     assert len([file for field in res['files'].values() for file in field]) == 1
 
 
-def test_local_multiple(book_file, image_file):
+def test_local_form(client, book_file):
+    """Test single file upload to local storage without the form model. All arguments are fixtures from the __init__."""
+    response = client.post('/local_form', files={'book': book_file})
+    assert response.status_code == 200
+    res = response.json()
+    assert res['status'] is True
+    assert res['file']['filename'] == book_file.name.rsplit('/', 1)[1]
+    assert res['file']['size'] == len(book_file.getvalue())
+
+
+def test_local_dedupe(client, book_file):
+    """Test files with the same content are hard linked in local storage. All arguments are fixtures from the __init__."""
+    content = book_file.read()
+    files = [('book', ('first.txt', content)), ('book', ('second.txt', content))]
+    response = client.post('/local_dedupe', files=files)
+    assert response.status_code == 200
+    res = response.json()
+    first, second = (os.stat(file['path']) for file in res['files']['book'])
+    assert first.st_ino == second.st_ino
+    assert first.st_size == len(content)
+
+
+def test_local_multiple(client, book_file, image_file):
     """
     Test multiple files upload to local storage.
     All arguments are fixtures from the __init__.
@@ -63,7 +100,19 @@ def test_local_multiple(book_file, image_file):
     assert len([file for field in res['files'].values() for file in field]) == 4
 
 
-def test_mem_single(image_file):
+def test_local_max_count(client, book_file, image_file):
+    """
+    Test max_count applies to the files that pass the filter in local storage.
+    All arguments are fixtures from the __init__.
+    """
+    files = [('books', image_file), ('books', ('first.txt', book_file.read())), ('books', ('second.txt', b'book'))]
+    response = client.post('/local_multiple', files=files, data={'title': 'Test Book', 'author_name': 'Tester'})
+    res = response.json()
+    assert response.status_code == 200
+    assert sorted(file['filename'] for file in res['files']['books']) == ['first.txt', 'second.txt']
+
+
+def test_mem_single(client, image_file):
     """
     Test single file upload to memory storage
     All arguments are fixtures from the __init__.
@@ -76,7 +125,7 @@ def test_mem_single(image_file):
     assert len([file for field in res['files'].values() for file in field]) == 1
 
 
-def test_mem_multiple(book_file, image_file):
+def test_mem_multiple(client, book_file, image_file):
     """
     Test multiple files upload to memory storage
     All arguments are fixtures from the __init__.
@@ -88,7 +137,20 @@ def test_mem_multiple(book_file, image_file):
     assert len([file for field in res['files'].values() for file in field]) == 3
 
 
-def test_filestore(book_file, image_file):
+def test_mem_max_filesize(client):
+    """
+    Test files larger than max_filesize are rejected before the filter runs.
+    All arguments are fixtures from the __init__.
+    """
+    FILTERED.clear()
+    files = [('books', ('over.txt', b'0' * (MAX_SIZE + 1))), ('books', ('under.txt', b'0' * MAX_SIZE))]
+    response = client.post('/memory_max_size', files=files)
+    assert response.status_code == 200
+    assert response.json() == ['under.txt']
+    assert FILTERED == ['under.txt']
+
+
+def test_filestore(client, book_file, image_file):
     """
     Test multiple files upload to memory storage
     All arguments are fixtures from the __init__.
@@ -97,4 +159,50 @@ def test_filestore(book_file, image_file):
                                                 ('covers', image_file), ('covers', image_file)], data={'title': 'Test Book'})
     res = response.json()
     assert response.status_code == 200
-    assert len(res) == 4
\ No newline at end of file
+    assert len(res) == 4
+
+
+def parse_form(body: bytes, content_type: str, threaded: bool, spool_max_size: int = None) -> list:
+    """
+    Parse a multipart body fed in small chunks with get_form and return the fields and the files read back, with
+    whether each file was rolled over to disk.
+    """
+    chunks = [body[i: i + 4096] for i in range(0, len(body), 4096)]
+
+    async def receive():
+        return {'type': 'http.request', 'body': chunks.pop(0), 'more_body': bool(chunks)}
+
+    async def parse():
+        req = Request({'type': 'http', 'method': 'POST', 'headers': [(b'content-type', content_type.encode())]},
+                      receive)
+        form = await get_form(req, threaded=threaded, spool_max_size=spool_max_size)
+        return [(name, value) if isinstance(value, str) else
+                (name, value.filename, value.size, await value.read(), value.headers.items(), value.file._rolled)
+                for name, value in form.multi_items()]
+    return asyncio.run(parse())
+
+
+def test_threaded_form(payload):
+    """
+    Test the threaded form parser gives the same form as Starlette's parser, so a change to the Starlette internals
+    it depends on is caught. All arguments are fixtures from the __init__.
+    """
+    files = [('book', ('book.txt', payload, 'text/plain')), ('covers', ('cover.png', payload[:1000], 'image/png')),
+             ('covers', ('empty.png', b'', 'image/png'))]
+    request = httpx.Request('POST', 'http://test', files=files, data={'title': 'Test Book'})
+    body, content_type = request.read(), request.headers['content-type']
+    threaded = parse_form(body, content_type, threaded=True)
+    assert threaded == parse_form(body, content_type, threaded=False)
+    assert [item[0] for item in threaded] == ['title', 'book', 'covers', 'covers']
+    assert threaded[1][3] == payload
+
+
+def test_spool_max_size(payload):
+    """Test files larger than spool_max_size are rolled over to disk. All arguments are fixtures from the __init__."""
+    files = [('covers', ('small.png', payload[:1000], 'image/png')),
+             ('covers', ('large.png', payload[:1001], 'image/png'))]
+    request = httpx.Request('POST', 'http://test', files=files)
+    body, content_type = request.read(), request.headers['content-type']
+    for threaded in (True, False):
+        small, large = parse_form(body, content_type, threaded=threaded, spool_max_size=1000)
+        assert small[-1] is False and large[-1] is True
@@ -8,40 +8,55 @@ from starlette.datastructures import FormData
 
 from filestore import LocalStorage, MemoryStorage, FileStore, S3Storage, LocalEngine, S3Engine
 
+IMAGE_EXTS = frozenset({'jpg', 'png', 'jpeg'})
+BOOK_EXTS = frozenset({'txt', 'pdf', 'epub', 'docx', 'doc'})
+MAX_SIZE = 1500000  # 1.5MB
+FILTERED = []  # the names of the files recording_filter was called with
+
+
+def _ext(name: str) -> str:
+    """Get the lowercase extension of a filename."""
+    return name.rpartition('.')[2].lower()
+
 
 def local_book_destination(req: Request, form: FormData, field: str, file: UploadFile) -> Path:
     """Get the title from the form and create a folder with the title as the folder name."""
-    folder = form['title']
-    path = Path.cwd() / f'test_data/uploads/Books/{folder}'
-    path.mkdir(parents=True, exist_ok=True) if not path.exists() else ...
+    path = Path.cwd() / f'test_data/uploads/Books/{form["title"]}'
+    path.mkdir(parents=True, exist_ok=True)
     return path / f'{file.filename}'
 
 
 def image_filter(req: Request, form: FormData, field: str, file: UploadFile) -> bool:
     """A filter function for the image files"""
-    return file.filename.rsplit('.', 1)[1].lower() in ['jpg', 'png', 'jpeg']
+    return _ext(file.filename) in IMAGE_EXTS
 
 
 def size_filter(req: Request, form: FormData, field: str, file: UploadFile) -> bool:
     """A filter function for the image files"""
-    return file.size <= 1500000  # 1.5MB
+    return file.size <= MAX_SIZE
 
 
 def book_filter(req: Request, form: FormData, field: str, file: UploadFile) -> bool:
-    return file.filename.rsplit('.', 1)[1].lower() in ['txt', 'pdf', 'epub', 'docx', 'doc']
+    return _ext(file.filename) in BOOK_EXTS
+
+
+def recording_filter(req: Request, form: FormData, field: str, file: UploadFile) -> bool:
+    """A filter function that records the names of the files it is called with in FILTERED"""
+    FILTERED.append(file.filename)
+    return True
 
 
 def cover_filename(req: Request, form: FormData, field: str, file: UploadFile) -> UploadFile:
     """A filename function for the cover file"""
     title = form['title']
-    file.filename = f'{title}_Cover.{file.filename.rsplit(".", maxsplit=1)[1]}'
+    file.filename = f'{title}_Cover.{file.filename.rpartition(".")[2]}'
     return file
 
 
 def author_filename(req: Request, form: FormData, field: str, file: UploadFile) -> UploadFile:
     """A filename function for the author file"""
     name = form['author_name']
-    file.filename = f'{name}.{file.filename.rsplit(".", maxsplit=1)[1]}'
+    file.filename = f'{name}.{file.filename.rpartition(".")[2]}'
     return file
 
 
@@ -64,8 +79,12 @@ single_mem = MemoryStorage(name='cover', required=True, config={'filter': image_
 multiple_mem = MemoryStorage(fields=[{'name': 'covers', 'max_count': 2, 'config': {'filter': image_filter}},
                                      {'name': 'book', 'config': {'filter': size_filter}}])
 
+max_size_mem = MemoryStorage(name='books', count=2, config={'max_filesize': MAX_SIZE, 'filter': recording_filter})
+
 single_local = LocalStorage(name='book', config={'destination': 'test_data/uploads/Books', 'filter': book_filter})
 
+dedupe_local = LocalStorage(name='book', count=2, config={'destination': 'test_data/uploads/Dedupe', 'dedupe': True})
+
 multiple_local = LocalStorage(fields=[{'name': 'books', 'max_count': 2, 'config': {'filter': book_filter}},
                                       {'name': 'cover', 'config': {'filename': cover_filename}}, {'name': 'author',
                                       'config': {'filename': author_filename}}],